@@ -28,8 +28,10 @@ setup(
     package_dir={'': 'src'},
     packages=find_packages(where='src'),
     python_requires='>=3.6, <4',
-    install_requires=['numpy>=1.0'],
+    install_requires=['numpy>=1.17'],
     extras_require={
+        'numba': ['numba>=0.50'],
+        'scipy': ['scipy>=1.1'],
         'dev': [
             'pylint>=2.0.0',
             'black>=19.10b0',
@@ -0,0 +1,161 @@
+"""
+Compiled kernels for the innermost loops, used when numba is installed.
+
+Without numba the decorators leave the functions as plain python, and the callers fall back to
+their vectorized numpy implementation: check NUMBA_AVAILABLE before dispatching here.
+"""
+import numpy as np
+
+try:
+    from numba import njit, prange
+
+    NUMBA_AVAILABLE = True
+except ImportError:  # pragma: no cover
+    NUMBA_AVAILABLE = False
+    prange = range  # type: ignore  # pylint: disable=invalid-name
+
+    def njit(*args, **kwargs):  # type: ignore  # pylint: disable=unused-argument
+        """ Stand-in for numba.njit that returns the function unchanged. """
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+
+# Integer codes of the sides of a linear constraint.
+SIDE_EQ = 0
+SIDE_LEQ = 1
+SIDE_GEQ = 2
+
+
+# No fastmath here either: it lets the compiler assume that there are no NaNs, which must fail.
+@njit(cache=True)
+def contains(
+    normals: np.ndarray,
+    constants: np.ndarray,
+    sides: np.ndarray,
+    tols: np.ndarray,
+    point: np.ndarray,
+) -> bool:
+    """
+    Check the point against the constraints, one row of 'normals' each, with the side encoded in
+    'sides' as SIDE_EQ, SIDE_LEQ or SIDE_GEQ. Return at the first violated constraint.
+
+    Each test negates the accepting comparison, so that NaN products violate the constraint.
+    """
+    for k in range(normals.shape[0]):
+        scalar_prod = 0.0
+        for j in range(normals.shape[1]):
+            scalar_prod += normals[k, j] * point[j]
+        if sides[k] == SIDE_EQ:
+            if not abs(scalar_prod - constants[k]) < tols[k]:
+                return False
+        elif sides[k] == SIDE_LEQ:
+            if not scalar_prod <= constants[k] + tols[k]:
+                return False
+        elif not scalar_prod >= constants[k] - tols[k]:
+            return False
+    return True
+
+
+@njit(cache=True, inline='always')
+def softmax(x: np.ndarray, out: np.ndarray) -> np.ndarray:
+    """
+    Softmax of 'x' written in 'out' and returned, shifted by the maximum, with exponentials and
+    sum fused in a single pass.
+    """
+    shift = x.max()
+    total = 0.0
+    for i in range(x.shape[0]):
+        out[i] = np.exp(x[i] - shift)
+        total += out[i]
+    for i in range(x.shape[0]):
+        out[i] /= total
+    return out
+
+
+# pylint: disable=too-many-arguments
+# No fastmath for the regression kernels: reassociated sums round differently depending on
+# the addresses of the arrays, and seeded fits would not be reproducible.
+@njit(cache=True)
+def loss_and_gradient(
+    base: np.ndarray,
+    target: np.ndarray,
+    lin_coefs: np.ndarray,
+    coefs: np.ndarray,
+    err: np.ndarray,
+    gradient: np.ndarray,
+) -> float:
+    """
+    Fused step of polyreg: write the softmax of 'lin_coefs' in 'coefs', the error in 'err' and the
+    gradient in 'gradient', and return the loss. The hull base has one point per column. The sums
+    are accumulated in float64 whatever the dtype of the arrays.
+    """
+    num_points = base.shape[1]
+    softmax(lin_coefs, coefs)
+    err[:] = target
+    for j in range(num_points):
+        for k in range(base.shape[0]):
+            err[k] -= base[k, j] * coefs[j]
+    loss = 0.0
+    for k in range(base.shape[0]):
+        loss += err[k] * err[k]
+    # The gradient -(err @ base) multiplied by the Jacobian of the softmax.
+    coefs_prod = 0.0
+    for j in range(num_points):
+        prod = 0.0
+        for k in range(base.shape[0]):
+            prod -= err[k] * base[k, j]
+        gradient[j] = prod
+        coefs_prod += coefs[j] * prod
+    for j in range(num_points):
+        gradient[j] = coefs[j] * (gradient[j] - coefs_prod)
+    return loss
+
+
+@njit(cache=True)
+def polyreg_euler(
+    base: np.ndarray,
+    target: np.ndarray,
+    lin_coefs: np.ndarray,
+    alpha: float,
+    tol: float,
+    max_iter: int,
+) -> bool:
+    """
+    The polyreg loop with the Euler update, in place on 'lin_coefs'. Return whether it converged.
+    """
+    coefs = np.empty_like(lin_coefs)
+    gradient = np.empty_like(lin_coefs)
+    err = np.empty_like(target)
+    prev_loss = 100000.0
+    for _ in range(max_iter):
+        loss = loss_and_gradient(base, target, lin_coefs, coefs, err, gradient)
+        if loss >= tol and loss > prev_loss:
+            alpha *= 0.9
+            continue
+        for j in range(lin_coefs.shape[0]):
+            lin_coefs[j] -= alpha * gradient[j]
+        if loss < tol:
+            return True
+        prev_loss = loss
+    return False
+
+
+@njit(cache=True, parallel=True)
+def polyreg_batch(
+    base: np.ndarray,
+    targets: np.ndarray,
+    lin_coefs: np.ndarray,
+    alphas: np.ndarray,
+    tol: float,
+    max_iter: int,
+) -> np.ndarray:
+    """
+    Run polyreg_euler for each row of 'targets' and 'lin_coefs', with the learning rate in the
+    same row of 'alphas', in parallel. The rows only share the read-only base, and the returned
+    array tells which of them converged.
+    """
+    converged = np.zeros(targets.shape[0], dtype=np.bool_)
+    for m in prange(targets.shape[0]):  # pylint: disable=not-an-iterable
+        converged[m] = polyreg_euler(base, targets[m], lin_coefs[m], alphas[m], tol, max_iter)
+    return converged
@@ -2,10 +2,17 @@
 Definition of geometrical objects.
 """
 import logging
-from typing import Tuple, List, Optional
+from typing import Tuple, List, Optional, Union
 
 import numpy as np
 
+from eukleides import _kernels
+
+try:
+    from scipy import optimize
+except ImportError:  # pragma: no cover
+    optimize = None
+
 
 class HyperPlane:
     """
@@ -13,12 +20,18 @@ class HyperPlane:
 
     Defined by its normal vector 'normal' and the 'constant', such that a point x belongs to the
     hyperplane iff $normal ⋅ x = constant$.
+
+    The normal is copied into a read-only contiguous array of the given dtype, so that the
+    quantities derived from it at construction stay valid.
     """
     tol = 1e-8
 
-    def __init__(self, normal: np.ndarray, constant: float = 0.0):
-        self.normal = normal
+    def __init__(self, normal: np.ndarray, constant: float = 0.0, dtype: type = np.float64):
+        self.normal: np.ndarray = np.array(normal, dtype=dtype, order='C')
+        assert np.any(self.normal), 'The normal vector cannot be zero.'
+        self.normal.flags.writeable = False
         self.constant = constant
+        self._inv_nn = 1.0 / np.dot(self.normal, self.normal)
 
     @property
     def dim(self) -> Tuple[int, ...]:
@@ -31,44 +44,96 @@ class HyperPlane:
         scalar_product = np.dot(self.normal, point)
         return abs(scalar_product - self.constant) < self.tol
 
+    def contains_batch(self, points: np.ndarray) -> np.ndarray:
+        """
+        Check which points belong to the plane. The points are stacked along the first axis, best
+        as a C-contiguous (M, d) array so that the products are computed by a single BLAS call.
+        """
+        assert self.dim == points.shape[1:], f'Dimension mismatch: {self.dim} != {points.shape[1:]}'
+        return np.abs(points @ self.normal - self.constant) < self.tol
+
     def project(self, point: np.ndarray) -> np.ndarray:
         """
         Solve the equation (v is hyperplane normal vector and c the constant term)
         p \\cdot v - t |v|^2 + c = 0
         in t to determine the intersection of the parametric line.
         """
-        t = (np.dot(point, self.normal) - self.constant) / np.dot(self.normal, self.normal)
+        t = (np.dot(point, self.normal) - self.constant) * self._inv_nn
         return point - t * self.normal
 
 
 class LinearConstraint(HyperPlane):
     """
     Extends the hyperplane with an extra method to check if the desired (in)equality is satisfied.
+
+    The check for the side and the thresholds including the tolerance are fixed at construction.
     """
-    def __init__(self, normal: np.ndarray, constant: float = 0.0, side: str = 'leq'):
-        super().__init__(normal, constant)
+    def __init__(
+        self, normal: np.ndarray, constant: float = 0.0, side: str = 'leq', dtype: type = np.float64
+    ):
+        super().__init__(normal, constant, dtype)
         assert side in {'eq', 'leq', 'geq'}
         self.side = side
+        self._upper = constant + self.tol
+        self._lower = constant - self.tol
+        self._check = {
+            'eq': super().contains,
+            'leq': self._check_leq,
+            'geq': self._check_geq,
+        }[side]
+
+    def _check_leq(self, point: np.ndarray) -> bool:
+        return np.dot(self.normal, point) <= self._upper
+
+    def _check_geq(self, point: np.ndarray) -> bool:
+        return np.dot(self.normal, point) >= self._lower
 
     def contains(self, point: np.ndarray):
+        return self._check(point)
+
+    def contains_batch(self, points: np.ndarray) -> np.ndarray:
         if self.side == 'eq':
-            return super().contains(point)
-        scalar_prod = np.dot(self.normal, point)
+            return super().contains_batch(points)
+        assert self.dim == points.shape[1:], f'Dimension mismatch: {self.dim} != {points.shape[1:]}'
+        scalar_prods = points @ self.normal
         if self.side == 'leq':
-            return scalar_prod <= self.constant + self.tol
+            return scalar_prods <= self._upper
         if self.side == 'geq':
-            return scalar_prod >= self.constant - self.tol
+            return scalar_prods >= self._lower
         raise ValueError(f'side should be eq, leq or geq, found {self.side}')
 
 
-class Polytope:
-    """ Polytope of any dimension, defined as intersection of hyperplanes or half-spaces. """
+class Polytope:  # pylint: disable=too-many-instance-attributes
+    """
+    Polytope of any dimension, defined as intersection of hyperplanes or half-spaces.
+
+    The constraints are also packed into a matrix of normals, one per row, together with the
+    constants, the tolerances and the sides, so that membership is checked either by a compiled
+    loop that stops at the first violated constraint, or with a single matrix-vector product
+    followed by branchless comparisons of all the constraints.
+    """
     def __init__(self, constraints: List[LinearConstraint]):
         self.dim = constraints[0].normal.shape
         for constr in constraints:
             assert constr.normal.shape == self.dim
         self._constraints = constraints
         self.logger = logging.getLogger(__name__)
+        self._pack()
+
+    def _pack(self):
+        """ Stack the constraints into arrays, to be rebuilt whenever a constraint is added. """
+        self._normals = np.stack([constr.normal for constr in self._constraints])
+        self._constants = np.array([constr.constant for constr in self._constraints])
+        self._tols = np.array([constr.tol for constr in self._constraints])
+        self._upper = self._constants + self._tols
+        self._lower = self._constants - self._tols
+        sides = np.array([constr.side for constr in self._constraints])
+        self._eq = sides == 'eq'
+        self._leq = sides == 'leq'
+        self._geq = sides == 'geq'
+        self._sides = np.full(len(sides), _kernels.SIDE_EQ, dtype=np.int8)
+        self._sides[self._leq] = _kernels.SIDE_LEQ
+        self._sides[self._geq] = _kernels.SIDE_GEQ
 
     @property
     def constraints(self):
@@ -77,32 +142,118 @@ class Polytope:
     def add_constraint(self, constraint: LinearConstraint):
         assert constraint.normal.shape == self.dim
         self._constraints.append(constraint)
+        self._pack()
 
-    def contains(self, point: np.ndarray):
-        return all(constr.contains(point) for constr in self.constraints)
+    def _satisfied(self, prods: np.ndarray) -> np.ndarray:
+        """ Which constraints are satisfied, given the scalar products along the last axis. """
+        return np.where(
+            self._eq,
+            np.abs(prods - self._constants) < self._tols,
+            np.where(self._leq, prods <= self._upper, prods >= self._lower),
+        )
+
+    def contains(self, point: np.ndarray, policy: str = 'auto'):
+        """
+        Check if the point belongs to the polytope, with one of two policies:
+        - 'early_exit' loops over the constraints in compiled code and stops at the first
+          violated one, the fastest when most points fail early;
+        - 'vectorized' checks all the constraints at once, which pays off when most points are
+          inside and is used for 'early_exit' too when numba is not installed.
+        The default 'auto' picks 'early_exit' when numba is available.
+        """
+        assert policy in {'auto', 'early_exit', 'vectorized'}
+        assert self.dim == point.shape, f'Dimension mismatch: {self.dim} != {point.shape}'
+        if _kernels.NUMBA_AVAILABLE and policy != 'vectorized':
+            return _kernels.contains(
+                self._normals, self._constants, self._sides, self._tols, point
+            )
+        return bool(np.logical_and.reduce(self._satisfied(self._normals @ point)))
+
+    def contains_batch(self, points: np.ndarray) -> np.ndarray:
+        """
+        Check which points belong to the polytope. The points are stacked along the first axis,
+        best as a C-contiguous (M, d) array: all the scalar products are then computed by a single
+        matrix product of shape (M, K), K being the number of constraints.
+        """
+        assert self.dim == points.shape[1:], f'Dimension mismatch: {self.dim} != {points.shape[1:]}'
+        return np.logical_and.reduce(self._satisfied(points @ self._normals.T), axis=1)
 
     def project(self, point: np.ndarray):
-        """ Project a point into the polytope. """
-        raise NotImplementedError('Work in progress.')
+        """
+        Project a point into the polytope, namely find the closest point of the polytope solving
+        the quadratic program min |x - point|^2 / 2 subject to the constraints with SLSQP.
+        Requires scipy, and raises a ValueError with the message of the solver if it fails, as
+        for an empty polytope.
+        """
+        if optimize is None:
+            raise ImportError('Polytope.project requires scipy.')
+        if self.contains(point):
+            # A copy, as for the points outside: the caller may modify the projection.
+            return np.array(point, dtype=np.float64)
+        # Inequalities in the form normals @ x - constants >= 0, as expected by scipy.
+        ineq_normals = np.concatenate([-self._normals[self._leq], self._normals[self._geq]])
+        ineq_constants = np.concatenate([-self._constants[self._leq], self._constants[self._geq]])
+        eq_normals, eq_constants = self._normals[self._eq], self._constants[self._eq]
+        constraints = []
+        if len(ineq_normals):
+            constraints.append({
+                'type': 'ineq',
+                'fun': lambda x: ineq_normals @ x - ineq_constants,
+                'jac': lambda x: ineq_normals,
+            })
+        if len(eq_normals):
+            constraints.append({
+                'type': 'eq',
+                'fun': lambda x: eq_normals @ x - eq_constants,
+                'jac': lambda x: eq_normals,
+            })
+        result = optimize.minimize(
+            lambda x: 0.5 * np.dot(x - point, x - point),
+            x0=point,
+            jac=lambda x: x - point,
+            constraints=constraints,
+            method='SLSQP',
+        )
+        if not result.success:
+            raise ValueError(f'projection did not converge: {result.message}')
+        return result.x
 
 
 
 class ConvexHull:
-    """ Convex hull generated as convex combination of a finite set of points. """
-    def __init__(self, points: List[np.ndarray]):
-        _dimensions = [vec.shape for vec in points]
-        assert all(dim == _dimensions[0] for dim in _dimensions)
-        self.points: List[np.ndarray] = points
-        self._base: Optional[np.ndarray] = None  # pylint: disable=E1136
+    """
+    Convex hull generated as convex combination of a finite set of points, given as a sequence of
+    vectors of the same shape or already stacked in an array with one point per row.
+    """
+    def __init__(self, points: Union[List[np.ndarray], np.ndarray], dtype: type = np.float64):
+        stacked = np.asarray(points)
+        assert stacked.ndim == 2, f'Points should be vectors of the same shape: {stacked.shape}'
+        # A single read-only buffer, copied so that the caller's array is not frozen. The Fortran
+        # order keeps each point contiguous, which is what the products with the coefficients,
+        # base @ coefs and err @ base, read, and makes base.T C-contiguous.
+        self._base: np.ndarray = np.array(stacked.T, dtype=dtype, order='F')
+        self._base.flags.writeable = False
+        self._gram: Optional[np.ndarray] = None  # pylint: disable=E1136
+
+    @property
+    def points(self) -> np.ndarray:
+        """ The points generating the convex hull, as a read-only view with one point per row. """
+        return self._base.T
 
     @property
     def base(self) -> np.ndarray:
-        """ An array with all the points stacked, where the first index indexes the points. """
-        if self._base is None:
-            self._base = np.array(self.points).T
+        """ An array with all the points stacked, where the second index indexes the points. """
         return self._base
 
+    @property
+    def gram(self) -> np.ndarray:
+        """ Gram matrix base^T base of the points, computed once for all the regressions. """
+        if self._gram is None:
+            self._gram = self._base.T @ self._base
+            self._gram.flags.writeable = False
+        return self._gram
+
     @property
     def num_points(self) -> int:
         """ Number of points of the convex hull. """
-        return len(self.points)
+        return self._base.shape[1]
@@ -1,30 +1,60 @@
-""" Numeric methods to implement the gradient flow for continuous optimization problems. """
-from typing import Callable, Union
+"""
+Numeric methods to implement the gradient flow for continuous optimization problems.
+
+The update methods accept an optional 'out' array, with the shape of the value, that receives the
+update and also holds the intermediate points, so that a caller looping over them can reuse it.
+"""
+import logging
+import operator
+from typing import Callable, Optional, Union
 
 import numpy as np
 
 
 Gradient = Callable[[np.ndarray], np.ndarray]
 
-
-def euler_update(value: np.ndarray, gradient_func: Gradient, alpha: float):
-    return alpha * gradient_func(value)
+logger = logging.getLogger(__name__)
 
 
-def improved_euler_update(value: np.ndarray, gradient_func: Gradient, alpha: float):
-    first_gradient = gradient_func(value)
-    second_gradient = gradient_func(value + alpha * first_gradient)
-    return 0.5 * alpha * (first_gradient + second_gradient)
+def euler_update(
+    value: np.ndarray, gradient_func: Gradient, alpha: float, out: Optional[np.ndarray] = None
+):
+    return np.multiply(gradient_func(value), alpha, out=out)
 
 
-def runge_kutta_update(value: np.ndarray, gradient_func: Gradient, alpha: float):
+def improved_euler_update(
+    value: np.ndarray, gradient_func: Gradient, alpha: float, out: Optional[np.ndarray] = None
+):
     first_gradient = gradient_func(value)
-    second_gradient = gradient_func(value + 0.5 * alpha * first_gradient)
-    third_gradient = gradient_func(value + 0.5 * alpha * second_gradient)
-    fourth_gradient = gradient_func(value + alpha * third_gradient)
-    return (alpha / 6.0) * (
-        first_gradient + 2.0 * second_gradient + 2.0 * third_gradient + fourth_gradient
-    )
+    out = np.multiply(first_gradient, alpha, out=out)
+    out += value
+    second_gradient = gradient_func(out)
+    np.add(first_gradient, second_gradient, out=out)
+    out *= 0.5 * alpha
+    return out
+
+
+def runge_kutta_update(
+    value: np.ndarray, gradient_func: Gradient, alpha: float, out: Optional[np.ndarray] = None
+):
+    """ Besides 'out', only one intermediate point is allocated. """
+    first_gradient = gradient_func(value)
+    point = np.multiply(first_gradient, 0.5 * alpha)
+    point += value
+    second_gradient = gradient_func(point)
+    out = np.multiply(second_gradient, 2.0, out=out)
+    out += first_gradient
+    np.multiply(second_gradient, 0.5 * alpha, out=point)
+    point += value
+    third_gradient = gradient_func(point)
+    np.multiply(third_gradient, alpha, out=point)
+    point += value
+    fourth_gradient = gradient_func(point)
+    np.multiply(third_gradient, 2.0, out=point)
+    out += point
+    out += fourth_gradient
+    out *= alpha / 6.0
+    return out
 
 
 def polynomial_decrease_step(step_number: int, initial_alpha: float = 1.0, exponent: float = 0.5):
@@ -35,40 +65,47 @@ def polynomial_decrease_step(step_number: int, initial_alpha: float = 1.0, expon
 
 
 class EarlyStopper:
-    """ After a given number of attempts of increasing the objective, it stops. """
+    """
+    After a given number of attempts of increasing the objective, it stops.
+
+    The objectives are stored as python floats, and the progress is logged at debug level.
+    """
     def __init__(self, max_fails: int = 3, direction: str = 'maximize'):
         assert direction in {'minimize', 'maximize'}
         self.max_fails: int = max_fails
         self.best_objective: Union[None, float] = None  # pylint: disable=E1136
-        self.fails: int = 0
+        self._fails: int = 0
         self.direction: str = direction
+        self._cmp = operator.gt if direction == 'maximize' else operator.lt
+
+    @property
+    def fails(self) -> int:
+        """ Number of consecutive attempts without improvement. """
+        return self._fails
 
     def is_better(self, new_objective: float) -> bool:
         if self.best_objective is None:
             raise ValueError('Best objective is still None, cannot compare.')
-        if self.direction == 'maximize':
-            return new_objective > self.best_objective
-        if self.direction == 'minimize':
-            return self.best_objective > new_objective
-        raise ValueError(f'Optimization direction not understood: {self.direction}')
+        return self._cmp(float(new_objective), self.best_objective)
 
     def reset(self):
-        self.fails = 0
+        self._fails = 0
         self.best_objective = None
         return self
 
     def stop(self, new_objective: float) -> bool:
+        new_objective = float(new_objective)
         if self.best_objective is None:
             self.best_objective = new_objective
             return False
-        if self.is_better(new_objective):
-            print(f'Improved by {abs(new_objective - self.best_objective)}')
+        if self._cmp(new_objective, self.best_objective):
+            logger.debug('Improved by %s', abs(new_objective - self.best_objective))
             self.best_objective = new_objective
-            self.fails = 0
+            self._fails = 0
         else:
-            print(f'No improvement, attempt {self.fails} out of {self.max_fails}.')
-            self.fails += 1
-        if self.fails + 1 >= self.max_fails:
-            print(f'Stop: {self.max_fails} failed attempts.')
+            logger.debug('No improvement, attempt %d out of %d.', self._fails, self.max_fails)
+            self._fails += 1
+        if self._fails + 1 >= self.max_fails:
+            logger.debug('Stop: %d failed attempts.', self.max_fails)
             return True
         return False
@@ -2,18 +2,46 @@
 Polytope regression: find a convex combination of the vertices of the polytope that determine the
 given point.
 """
+import inspect
 import logging
-from typing import Callable
+import math
+import warnings
+from functools import partial
+from typing import Callable, Sequence, Tuple, Union
 
 import numpy as np
 
-from eukleides import ConvexHull
+from eukleides import ConvexHull, _kernels
 from eukleides import optimization as opt
 
+try:
+    from scipy import optimize
+except ImportError:  # pragma: no cover
+    optimize = None
+
+
+# Default generator for the initial coefficients, pass your own or a seed to polyreg instead.
+_rng = np.random.default_rng()
+
+Seed = Union[None, int, np.random.Generator]  # pylint: disable=E1136
+
+# Up to this number of vertices the compiled kernels beat numpy, which has a fixed overhead per
+# call but computes the exponentials of large hulls faster.
+COMPILED_MAX_POINTS = 1000
+
 
 def softmax(x: np.ndarray) -> np.ndarray:
-    expo = np.exp(x)
-    return expo / np.sum(expo)
+    """
+    Softmax along the last axis, shifted by the maximum so that the exponentials cannot overflow.
+    """
+    expo = np.exp(x - x.max(axis=-1, keepdims=True))
+    return expo / expo.sum(axis=-1, keepdims=True)
+
+
+def log_softmax(x: np.ndarray) -> np.ndarray:
+    """ Logarithm of the softmax, computed with the same shift so that it is finite. """
+    shifted = x - x.max(axis=-1, keepdims=True)
+    return shifted - np.log(np.exp(shifted).sum(axis=-1, keepdims=True))
 
 
 def get_convex_combination(hull: ConvexHull, lin_coefs: np.ndarray) -> np.ndarray:
@@ -28,19 +56,241 @@ def calc_error(hull: ConvexHull, target: np.ndarray, lin_coefs: np.ndarray):
 
 def calc_loss(hull: ConvexHull, target: np.ndarray, lin_coeffs: np.ndarray):
     err = calc_error(hull, target, lin_coeffs)
-    return np.dot(err, err)
+    return err @ err
 
 
 def comb_gradient(lin_coefs: np.ndarray):
+    """
+    Jacobian of the softmax, kept as the reference for _softmax_jvp in the tests. Deprecated: use
+    _softmax_jvp to apply it to a vector.
+    """
+    warnings.warn(
+        'comb_gradient is deprecated, the gradients apply the Jacobian without materializing it.',
+        DeprecationWarning,
+        stacklevel=2,
+    )
     coefs = softmax(lin_coefs)
-    return np.diag(coefs) - coefs.reshape((-1, 1)) @ coefs.reshape((1, -1))
+    jacobian = np.multiply.outer(coefs, coefs)
+    np.negative(jacobian, out=jacobian)
+    jacobian.flat[::coefs.size + 1] += coefs
+    return jacobian
+
+
+def _softmax_jvp(coefs: np.ndarray, vec: np.ndarray) -> np.ndarray:
+    """
+    Product of the vector with the Jacobian diag(coefs) - coefs coefs^T of the softmax, where
+    coefs is the softmax output: O(n) instead of the O(n^2) of materializing the matrix.
+    Both can also be stacked along the first axis, one product per row.
+    """
+    if vec.ndim == 1:
+        return coefs * (vec - coefs @ vec)
+    return coefs * (vec - (coefs * vec).sum(axis=1, keepdims=True))
+
+
+def _loss_and_gradient(
+    base: np.ndarray, target: np.ndarray, lin_coefs: np.ndarray
+) -> Tuple[float, np.ndarray]:
+    """ Same as calc_loss and loss_gradient, sharing the softmax and the error between the two. """
+    coefs = softmax(lin_coefs)
+    err = target - base @ coefs
+    # The loss is accumulated in float64 for a stable convergence check, at the cost of a copy of
+    # the error for lower precisions only.
+    wide_err = err.astype(np.float64, copy=False)
+    # base.T is C-contiguous, as the hull base is stored in Fortran order: no copy is involved.
+    return wide_err @ wide_err, _softmax_jvp(coefs, -(base.T @ err))
 
 
 def loss_gradient(hull: ConvexHull, target: np.ndarray, lin_coefs: np.ndarray) -> np.ndarray:
-    return -(calc_error(hull, target, lin_coefs) @ hull.base) @ comb_gradient(lin_coefs)
+    return _loss_and_gradient(hull.base, target, lin_coefs)[1]
+
+
+def _compiled_loss_and_gradient(
+    base: np.ndarray, target: np.ndarray, coefs: np.ndarray, err: np.ndarray, lin_coefs: np.ndarray
+) -> Tuple[float, np.ndarray]:
+    """ Same as _loss_and_gradient in a single compiled kernel, with scratch coefs and err. """
+    gradient = np.empty_like(lin_coefs)
+    loss = _kernels.loss_and_gradient(base, target, lin_coefs, coefs, err, gradient)
+    return loss, gradient
+
+
+def _batch_loss_and_gradient(
+    base: np.ndarray, targets: np.ndarray, lin_coefs: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Same as _loss_and_gradient with targets and coefficients stacked one per row: the products
+    with the base of all the rows are single matrix products.
+    """
+    coefs = softmax(lin_coefs)
+    err = targets - coefs @ base.T
+    losses = np.einsum('md,md->m', err, err, dtype=np.float64)
+    return losses, _softmax_jvp(coefs, -(err @ base))
+
+
+def _gram_loss_and_gradient(
+    gram: np.ndarray, base_target: np.ndarray, target_sq: float, lin_coefs: np.ndarray
+) -> Tuple[float, np.ndarray]:
+    """
+    Same as _loss_and_gradient, given B^T B, B^T t and |t|^2: the loss is expanded as
+    |t|^2 - 2 t^T B c + c^T B^T B c and -(err @ B) is replaced by B^T B c - B^T t.
+
+    The expansion cancels out as the loss approaches zero, so it is always computed in float64
+    and only the gradient is cast back to the dtype of the coefficients.
+    """
+    coefs = softmax(lin_coefs.astype(np.float64, copy=False))
+    gram_coefs = gram @ coefs
+    loss = target_sq - 2.0 * base_target @ coefs + coefs @ gram_coefs
+    gradient = _softmax_jvp(coefs, gram_coefs - base_target)
+    return loss, gradient.astype(lin_coefs.dtype, copy=False)
+
+
+def _objective(hull: ConvexHull, base: np.ndarray, target: np.ndarray) -> Callable:
+    """
+    Loss and gradient as a function of the linear coefficients only, for the fastest path, given
+    the hull base cast to the dtype of the target.
+    """
+    if base.shape[1] < base.shape[0]:
+        # With fewer vertices than dimensions, the products with the (n, n) Gram matrix are
+        # cheaper than the two products with the (d, n) base, and the hull computes it only once.
+        wide_target = target.astype(np.float64, copy=False)
+        base_target = hull.base.T @ wide_target
+        target_sq = float(wide_target @ wide_target)
+        return partial(_gram_loss_and_gradient, hull.gram, base_target, target_sq)
+    if _kernels.NUMBA_AVAILABLE and base.shape[1] < COMPILED_MAX_POINTS:
+        scratch = np.empty(base.shape[1], dtype=base.dtype), np.empty_like(target)
+        return partial(_compiled_loss_and_gradient, base, target, *scratch)
+    return partial(_loss_and_gradient, base, target)
+
+
+def precompile(dtypes: Sequence[type] = (np.float64, np.float32)) -> None:
+    """
+    Compile the kernels behind polyreg and polyreg_many for the given dtypes, both for hulls built
+    with that dtype and for float64 hulls cast to it, so that the first fit does not pay for the
+    compilation. The kernels are cached on disk, so later processes only load them. Without numba
+    there is nothing to compile.
+
+    This is not an ahead-of-time build: numba and its JIT are still needed wherever the fits run,
+    precompile only moves the compilation, or the load from the cache, before the first fit.
+    """
+    if not _kernels.NUMBA_AVAILABLE:
+        return
+    for dtype in dtypes:
+        for hull_dtype in [np.float64] if np.dtype(dtype) == np.float64 else [np.float64, dtype]:
+            hull = ConvexHull(np.eye(2), dtype=hull_dtype)
+            base: np.ndarray = hull.base.astype(dtype, copy=False)
+            targets: np.ndarray = np.zeros((1, 2), dtype=dtype)
+            lin_coefs: np.ndarray = np.zeros((1, 2), dtype=dtype)
+            _kernels.polyreg_euler(base, targets[0], lin_coefs[0], 1.0, 1.0, 0)
+            _kernels.polyreg_batch(base, targets, lin_coefs, np.ones(1), 1.0, 0)
+            _objective(hull, base, targets[0])(lin_coefs[0])
+
+
+def _initial_coefs(rng: Seed, shape: Tuple[int, ...], dtype: type) -> np.ndarray:
+    """
+    Small random linear coefficients, drawn from the generator, or from a new one seeded with
+    'rng' if it is an int, or from the generator of the module if it is None.
+    """
+    generator = _rng if rng is None else np.random.default_rng(rng)
+    return (0.001 * generator.standard_normal(shape)).astype(dtype)
+
+
+def _cast_tol(tol: float, dtype: type) -> float:
+    """ Raise the tolerance to a few machine epsilons of 'dtype', below which it cannot resolve. """
+    return max(tol, 10.0 * float(np.finfo(dtype).eps))  # pylint: disable=no-member
+
+
+# pylint: disable=too-many-arguments, too-many-locals
+def _descend(
+    loss_and_gradient: Callable,
+    lin_coefs: np.ndarray,
+    alpha: float,
+    tol: float,
+    max_iter: int,
+    update_method: Callable,
+) -> np.ndarray:
+    """ The optimization loop of polyreg, starting from the given coefficients. """
+    def inverse_gradient(value):
+        # The first stage of the update is at the current coefficients: reuse their gradient.
+        if value is lin_coefs:
+            return - vecto
+        return - loss_and_gradient(value)[1]
+
+    logger = logging.getLogger('polyreg')
+    # Buffers reused across the iterations: the next coefficients and, if the update method
+    # supports it, the update itself.
+    new_lin_coefs = np.empty_like(lin_coefs)
+    update_kwargs = {}
+    if 'out' in inspect.signature(update_method).parameters:
+        update_kwargs['out'] = np.empty_like(lin_coefs)
+    # Checked once: the progress is neither computed nor formatted unless it is logged.
+    log_progress = logger.isEnabledFor(logging.INFO)
+    prev_loss = 100000.0
+    for i in range(max_iter):
+        loss, vecto = loss_and_gradient(lin_coefs)
+        if log_progress and i % 100 == 0:
+            speed = math.sqrt(vecto @ vecto)
+            logger.info('Iter %d: loss = %.5f, speed = %.5f', i, loss, speed)
+        update = update_method(lin_coefs, inverse_gradient, alpha=alpha, **update_kwargs)
+        np.add(lin_coefs, update, out=new_lin_coefs)
+        if loss < tol:
+            logger.info('converged.')
+            lin_coefs = new_lin_coefs
+            break
+        if loss > prev_loss:
+            logger.info('loss increased, reducing the learning rate.')
+            alpha *= 0.9
+        else:
+            prev_loss = loss
+            lin_coefs, new_lin_coefs = new_lin_coefs, lin_coefs
+    else:
+        logger.warning('did not converge.')
+
+    return lin_coefs
+
+
+def _descend_batch(
+    base: np.ndarray,
+    targets: np.ndarray,
+    lin_coefs: np.ndarray,
+    alpha: float,
+    tol: float,
+    max_iter: int,
+    update_method: Callable,
+) -> np.ndarray:
+    """
+    The optimization loop of polyreg for all the rows of 'targets' at once, in place on the rows
+    of 'lin_coefs'. Each row has its own learning rate, and converged rows are left out.
+    """
+    def inverse_gradient(value):
+        if value is current:
+            return - vecto
+        return - _batch_loss_and_gradient(base, current_targets, value)[1]
+
+    alphas = np.full((len(targets), 1), alpha, dtype=lin_coefs.dtype)
+    prev_losses = np.full(len(targets), 100000.0)
+    active = np.arange(len(targets))
+    current_targets = targets
+    for _ in range(max_iter):
+        if not active.size:
+            break
+        current = lin_coefs[active]
+        loss, vecto = _batch_loss_and_gradient(base, current_targets, current)
+        update = update_method(current, inverse_gradient, alpha=alphas[active])
+        converged = loss < tol
+        increased = ~converged & (loss > prev_losses[active])
+        improved = active[~increased]
+        lin_coefs[improved] = (current + update)[~increased]
+        prev_losses[improved] = loss[~increased]
+        alphas[active[increased]] *= 0.9
+        if converged.any():
+            active = active[~converged]
+            current_targets = targets[active]
+    if active.size:
+        logging.getLogger('polyreg').warning(
+            '%d out of %d targets did not converge.', active.size, len(targets)
+        )
+    return lin_coefs
 
 
-# pylint: disable=too-many-arguments
 def polyreg(
     hull: ConvexHull,
     target: np.ndarray,
@@ -48,6 +298,8 @@ def polyreg(
     tol: float = 1e-4,
     max_iter: int = 10000,
     update_method: Callable = opt.euler_update,
+    dtype: type = np.float64,
+    rng: Seed = None,
 ) -> np.ndarray:
     """
     Given the convex hull of a point, use the optimization algorithm of choice to compute the
@@ -55,32 +307,156 @@ def polyreg(
     target point. If the target point does not lie in the convex hull, the algorithm will converge
     to the point in the convex hull that minimizes the distance from the target, namely its
     projection.
+
+    All the arrays of the loop are cast to 'dtype', where np.float32 halves the memory traffic of
+    the products with the hull base and is recommended for large hulls: build the hull with the
+    same dtype to skip the cast of its base at each call. The loss is still accumulated in
+    float64. The tolerance is raised to a few multiples of the machine epsilon of 'dtype' if it is
+    below, since the loss cannot be resolved further.
+
+    The initial coefficients are drawn from 'rng', either a generator or the seed of a new one,
+    defaulting to a generator shared by the module: pass a seed for reproducible results. They
+    are drawn in python also for the compiled loop, so that both start from the same point.
+
+    With numba and the Euler update, hulls with less than COMPILED_MAX_POINTS vertices run the
+    whole loop in compiled code, logging only the outcome.
     """
-    def inverse_gradient(lin_coefs):
-        return - loss_gradient(hull, target, lin_coefs)
+    base: np.ndarray = hull.base.astype(dtype, copy=False)
+    target = target.astype(dtype, copy=False)
+    tol = _cast_tol(tol, dtype)
+    logger = logging.getLogger('polyreg')
+    logger.info('using %s', update_method.__name__)
+    lin_coefs = _initial_coefs(rng, (hull.num_points, ), dtype)
+    if (
+        _kernels.NUMBA_AVAILABLE
+        and update_method is opt.euler_update
+        and hull.num_points < COMPILED_MAX_POINTS
+    ):
+        if _kernels.polyreg_euler(base, target, lin_coefs, alpha, tol, max_iter):
+            logger.info('converged.')
+        else:
+            logger.warning('did not converge.')
+        return lin_coefs
+    return _descend(_objective(hull, base, target), lin_coefs, alpha, tol, max_iter, update_method)
+
 
+def polyreg_many(
+    hull: ConvexHull,
+    targets: np.ndarray,
+    alpha: float = 1.0,
+    tol: float = 1e-4,
+    max_iter: int = 10000,
+    update_method: Callable = opt.euler_update,
+    dtype: type = np.float64,
+    rng: Seed = None,
+) -> np.ndarray:
+    """
+    Same as polyreg for each row of 'targets', returning the coefficients with one row per target.
+
+    The fits share the hull and are independent: with numba and the Euler update they run in
+    parallel in compiled code, otherwise all the rows are updated together, with one matrix
+    product for each product with the hull base. In the latter case the update method receives
+    the stacked coefficients and a column of learning rates, one per row, as 'alpha'.
+    """
+    base: np.ndarray = hull.base.astype(dtype, copy=False)
+    targets = np.ascontiguousarray(targets, dtype=dtype)
+    assert targets.ndim == 2 and targets.shape[1] == base.shape[0], \
+        f'Dimension mismatch: {targets.shape} for points of shape {base.shape[:1]}'
+    tol = _cast_tol(tol, dtype)
+    lin_coefs = _initial_coefs(rng, (len(targets), hull.num_points), dtype)
+    if _kernels.NUMBA_AVAILABLE and update_method is opt.euler_update:
+        alphas = np.full(len(targets), alpha)
+        converged = _kernels.polyreg_batch(base, targets, lin_coefs, alphas, tol, max_iter)
+        if not converged.all():
+            logging.getLogger('polyreg').warning(
+                '%d out of %d targets did not converge.', np.count_nonzero(~converged), len(targets)
+            )
+        return lin_coefs
+    return _descend_batch(base, targets, lin_coefs, alpha, tol, max_iter, update_method)
+
+
+def _lbfgs_objective(hull: ConvexHull, target: np.ndarray) -> Callable:
+    """
+    Loss and gradient of polyreg_lbfgs in float64. The fused steps return half the gradient of
+    the loss, a factor the descent of polyreg absorbs in the learning rate, while L-BFGS-B needs
+    the gradient of the very function it minimizes for its line search.
+    """
+    base: np.ndarray = hull.base.astype(np.float64, copy=False)
+    objective = _objective(hull, base, target.astype(np.float64, copy=False))
+
+    def loss_and_gradient(lin_coefs):
+        loss, gradient = objective(lin_coefs)
+        return loss, 2.0 * gradient
+
+    return loss_and_gradient
+
+
+def polyreg_lbfgs(
+    hull: ConvexHull,
+    target: np.ndarray,
+    tol: float = 1e-4,
+    max_iter: int = 10000,
+    rng: Seed = None,
+) -> np.ndarray:
+    """
+    Same as polyreg, minimizing the loss over the linear coefficients with the L-BFGS-B method of
+    scipy instead: the softmax makes the problem unconstrained, and the quasi-Newton steps need
+    far fewer iterations than the gradient descent, with no learning rate to tune.
+
+    The fit stops when the largest component of the gradient falls below 'tol' divided by the
+    number of vertices, since the softmax scales each component by its coefficient. Unlike the
+    loss, the gradient also vanishes for targets outside of the hull, at their projection.
+    """
+    if optimize is None:
+        raise ImportError('polyreg_lbfgs requires scipy.')
+    lin_coefs = _initial_coefs(rng, (hull.num_points, ), np.float64)
+    result = optimize.minimize(
+        _lbfgs_objective(hull, target),
+        x0=lin_coefs,
+        jac=True,
+        method='L-BFGS-B',
+        options={'gtol': tol / hull.num_points, 'maxiter': max_iter},
+    )
     logger = logging.getLogger('polyreg')
-    logger.info(f'using {update_method.__name__}')
-    lin_coefs = np.random.normal(size=hull.num_points, scale=0.001)
-    prev_loss = 100000.0
-    for i in range(max_iter):
-        loss = calc_loss(hull, target, lin_coefs)
-        vecto = loss_gradient(hull, target, lin_coefs)
-        speed = np.linalg.norm(vecto)
-        if i % 100 == 0:
-            logger.info(f'Iter {i}: loss = {loss:.5f}, speed = {speed:.5f}')
-        old_lin_coefs = lin_coefs
-        lin_coefs = lin_coefs + update_method(lin_coefs, inverse_gradient, alpha=alpha)
-        if loss < tol:
+    if result.success:
+        logger.info('converged in %d iterations.', result.nit)
+    else:
+        logger.warning('did not converge: %s', result.message)
+    return result.x
+
+
+def polyreg_fw(
+    hull: ConvexHull, target: np.ndarray, tol: float = 1e-4, max_iter: int = 200
+) -> np.ndarray:
+    """
+    Frank-Wolfe solution of the same problem as polyreg, directly on the coefficients of the
+    convex combination rather than on their logarithms: return the coefficients themselves.
+
+    Each iteration moves towards the vertex of least gradient, with the exact line search of the
+    quadratic loss, so the coefficients stay on the simplex and keep the zeros of the vertices
+    that are never picked. No exponentials are involved, and the residual is updated along the
+    way, leaving a single product with the hull base per iteration. The fit stops when the loss
+    or the duality gap, which bounds the distance of the loss from its minimum, is at most 'tol'.
+    """
+    base = hull.base
+    coefs = np.full(hull.num_points, 1.0 / hull.num_points)
+    residual = base @ coefs - target
+    logger = logging.getLogger('polyreg')
+    for _ in range(max_iter):
+        gradient = base.T @ residual
+        vertex = int(np.argmin(gradient))
+        # B (s - c), with B c = residual + target.
+        direction = base[:, vertex] - target - residual
+        sq_norm = direction @ direction
+        # A null direction means that the combination is the vertex already, with no step left.
+        gap = 2.0 * (gradient @ coefs - gradient[vertex])
+        if residual @ residual <= tol or gap <= tol or sq_norm == 0.0:
             logger.info('converged.')
             break
-        if loss > prev_loss:
-            logger.info('loss increased, reducing the learning rate.')
-            alpha *= 0.9
-            lin_coefs = old_lin_coefs
-        else:
-            prev_loss = loss
+        step = min(max(-(residual @ direction) / sq_norm, 0.0), 1.0)
+        coefs *= 1.0 - step
+        coefs[vertex] += step
+        residual += step * direction
     else:
         logger.warning('did not converge.')
-
-    return lin_coefs
+    return coefs
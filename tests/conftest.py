@@ -5,7 +5,7 @@ import numpy as np
 from eukleides import geometry as eg
 
 
-@pytest.fixture
+@pytest.fixture(scope='session')
 def horizontal_plane():
-    """ Horizontal plane in R^3 with equation x = 0.5 """
+    """ Horizontal plane in R^3 with equation x = 0.5, shared as its normal is read-only. """
     return eg.HyperPlane(np.array([1.0, 0.0, 0.0]), 0.5)
@@ -1,6 +1,20 @@
 import numpy as np
+import pytest
 
-from eukleides import HyperPlane, LinearConstraint, Polytope
+from eukleides import ConvexHull, HyperPlane, LinearConstraint, Polytope
+
+
+def _read_only(values):
+    array = np.array(values)
+    array.setflags(write=False)
+    return array
+
+
+# Normals shared by the constraints of the tests, which copy them.
+_N10 = _read_only([1.0, 0.0])
+_N01 = _read_only([0.0, 1.0])
+_N11 = _read_only([1.0, 1.0])
+_N1M1 = _read_only([1.0, -1.0])
 
 
 def test_hyper_plane(horizontal_plane):
@@ -18,18 +32,26 @@ def test_hyper_plane_project(horizontal_plane):
     assert horizontal_plane.contains(projection)
     assert np.array_equal(projection, np.array([0.5, 6.0, 2.0]))
 
-    np.random.seed(0)
-    for _ in range(10):
-        random_plane = HyperPlane(np.random.random(size=(10, )), np.random.random())
-        random_point = np.random.random(size=(10, ))
+    rng = np.random.default_rng(0)
+    normals = rng.random((10, 10))
+    constants = rng.random(10)
+    random_points = rng.random((10, 10))
+    for normal, constant, random_point in zip(normals, constants, random_points):
+        random_plane = HyperPlane(normal, constant)
         assert random_plane.contains(random_plane.project(random_point))
 
 
 def test_linear_constraint():
-    lcon = LinearConstraint(normal=np.array([1.0, 1.0]), constant=1.0, side='leq')
+    lcon = LinearConstraint(normal=_N11, constant=1.0, side='leq')
     assert not lcon.contains(np.array([0.5, 9.0]))
     assert lcon.contains(np.array([0.3, 0.7]))
 
+    normal = np.array([1, 1])
+    lcon = LinearConstraint(normal=normal, constant=1.0, side='geq', dtype=np.float32)
+    assert lcon.normal.dtype == np.float32
+    assert not lcon.normal.flags.writeable
+    assert normal.flags.writeable
+
 
 def test_constraint_project():
     """
@@ -37,16 +59,135 @@ def test_constraint_project():
     on random planes belong to those planes.
     """
     point = np.array([2.0, 2.0])
-    constraint = LinearConstraint(np.array([1.0, 1.0]), 1.0)
+    constraint = LinearConstraint(_N11, 1.0)
     assert np.array_equal(constraint.project(point), np.array([0.5, 0.5]))
 
-    np.random.seed(0)
-    for _ in range(10):
-        random_constr =  LinearConstraint(
-            2 * np.random.random(size=(10, )) - 1.0,
-            10.0 * np.random.random(),
-            side=np.random.choice(['leq', 'geq'])
-        )
-
-        random_point = np.random.random(size=(10, ))
+    rng = np.random.default_rng(0)
+    normals = 2 * rng.random((10, 10)) - 1.0
+    constants = 10.0 * rng.random(10)
+    sides = rng.choice(['leq', 'geq'], size=10)
+    random_points = rng.random((10, 10))
+    for normal, constant, side, random_point in zip(normals, constants, sides, random_points):
+        random_constr = LinearConstraint(normal, constant, side=side)
         assert random_constr.contains(random_constr.project(random_point))
+
+
+def test_polytope_contains():
+    """
+    Test the membership in the unit square with a diagonal cut, and check that the polytope
+    agrees with its constraints on random points, also after adding a constraint.
+    """
+    square = Polytope([
+        LinearConstraint(_N10, 0.0, side='geq'),
+        LinearConstraint(_N01, 0.0, side='geq'),
+        LinearConstraint(_N10, 1.0, side='leq'),
+        LinearConstraint(_N01, 1.0, side='leq'),
+    ])
+    assert square.contains(np.array([0.5, 0.5]))
+    assert square.contains(np.array([1.0, 0.0]))
+    assert not square.contains(np.array([1.5, 0.5]))
+
+    square.add_constraint(LinearConstraint(_N11, 1.0, side='leq'))
+    assert square.contains(np.array([0.3, 0.3]))
+    assert not square.contains(np.array([0.7, 0.7]))
+
+    ray = Polytope([
+        LinearConstraint(_N1M1, 0.0, side='eq'),
+        LinearConstraint(_N11, 2.0, side='leq'),
+    ])
+    assert ray.contains(np.array([0.5, 0.5]))
+    assert not ray.contains(np.array([0.5, 0.6]))
+    assert not ray.contains(np.array([1.5, 1.5]))
+    for policy in ['auto', 'early_exit', 'vectorized']:
+        assert not ray.contains(np.array([0.5, np.nan]), policy=policy)
+        assert not square.contains(np.array([np.nan, np.nan]), policy=policy)
+
+    rng = np.random.default_rng(0)
+    normals = 2 * rng.random((10, 5, 10)) - 1.0
+    constants = rng.random((10, 5))
+    sides = rng.choice(['leq', 'geq'], size=(10, 5))
+    random_points = rng.random((10, 10))
+    # A NaN coordinate violates every constraint, whichever the policy.
+    random_points[-1, 0] = np.nan
+    for k, random_point in enumerate(random_points):
+        constraints = [
+            LinearConstraint(normal, constant, side=side)
+            for normal, constant, side in zip(normals[k], constants[k], sides[k])
+        ]
+        polytope = Polytope(constraints)
+        expected = all(constr.contains(random_point) for constr in constraints)
+        for policy in ['auto', 'early_exit', 'vectorized']:
+            assert polytope.contains(random_point, policy=policy) == expected
+
+
+def test_contains_batch(horizontal_plane):
+    """ Check that the batched membership agrees with the pointwise one. """
+    points = np.array([[0.5, 9.0, 1.0], [2.0, 6.0, 2.0]])
+    assert np.array_equal(horizontal_plane.contains_batch(points), [True, False])
+
+    rng = np.random.default_rng(0)
+    normals = 2 * rng.random((10, 5, 10)) - 1.0
+    constants = rng.random((10, 5))
+    sides = rng.choice(['eq', 'leq', 'geq'], size=(10, 5))
+    all_points = rng.random((10, 20, 10))
+    for k, random_points in enumerate(all_points):
+        constraints = [
+            LinearConstraint(normal, constant, side=side)
+            for normal, constant, side in zip(normals[k], constants[k], sides[k])
+        ]
+        polytope = Polytope(constraints[1:])
+        random_points[0] = constraints[0].project(random_points[0])
+        for constr in constraints:
+            expected = [constr.contains(point) for point in random_points]
+            assert np.array_equal(constr.contains_batch(random_points), expected)
+        expected = [polytope.contains(point) for point in random_points]
+        assert np.array_equal(polytope.contains_batch(random_points), expected)
+
+
+def test_convex_hull():
+    points = [np.array([0.0, 0.0]), np.array([1.0, 0.0]), np.array([0.0, 1.0])]
+    hull = ConvexHull(points)
+    assert hull.num_points == 3
+    assert np.array_equal(hull.base, [[0.0, 1.0, 0.0], [0.0, 0.0, 1.0]])
+    assert all(np.array_equal(point, vec) for point, vec in zip(hull.points, points))
+    assert np.array_equal(ConvexHull(np.array(points)).base, hull.base)
+    assert hull.base.dtype == np.float64
+    assert not hull.base.flags.writeable
+    assert hull.points.shape == (3, 2)
+    assert np.array_equal(hull.gram, hull.base.T @ hull.base)
+    assert hull.gram is hull.gram
+    assert ConvexHull(points, dtype=np.float32).base.dtype == np.float32
+
+
+def test_polytope_project():
+    """
+    Projections on the unit square, on an edge and on a vertex, and on a ray, while an empty
+    polytope has no projection.
+    """
+    pytest.importorskip('scipy')
+    square = Polytope([
+        LinearConstraint(_N10, 0.0, side='geq'),
+        LinearConstraint(_N01, 0.0, side='geq'),
+        LinearConstraint(_N10, 1.0, side='leq'),
+        LinearConstraint(_N01, 1.0, side='leq'),
+    ])
+    inside = np.array([0.5, 0.5])
+    projection = square.project(inside)
+    assert np.array_equal(projection, inside)
+    assert not np.shares_memory(projection, inside)
+    assert np.allclose(square.project(np.array([2.0, 0.5])), np.array([1.0, 0.5]))
+    assert np.allclose(square.project(np.array([2.0, -3.0])), np.array([1.0, 0.0]))
+
+    ray = Polytope([
+        LinearConstraint(_N1M1, 0.0, side='eq'),
+        LinearConstraint(_N11, 2.0, side='leq'),
+    ])
+    assert np.allclose(ray.project(np.array([1.0, 0.0])), np.array([0.5, 0.5]))
+    assert np.allclose(ray.project(np.array([3.0, 2.0])), np.array([1.0, 1.0]))
+
+    empty = Polytope([
+        LinearConstraint(_N10, 1.0, side='geq'),
+        LinearConstraint(_N10, 0.0, side='leq'),
+    ])
+    with pytest.raises(ValueError):
+        empty.project(np.array([0.5, 0.5]))
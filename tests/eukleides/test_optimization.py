@@ -0,0 +1,40 @@
+import numpy as np
+
+from eukleides import optimization as opt
+
+
+def test_updates():
+    """
+    Compare the updates with the textbook formulas for the flow x' = -x, also when the result
+    is written in a given array.
+    """
+    def gradient_func(value):
+        return -value
+
+    value = np.array([1.0, -2.0, 0.5])
+    alpha = 0.1
+    expected = {
+        opt.euler_update: -alpha * value,
+        opt.improved_euler_update: (-alpha + 0.5 * alpha**2) * value,
+        opt.runge_kutta_update: (
+            -alpha + alpha**2 / 2.0 - alpha**3 / 6.0 + alpha**4 / 24.0
+        ) * value,
+    }
+    for update_method, update in expected.items():
+        assert np.allclose(update_method(value, gradient_func, alpha), update)
+        out = np.empty_like(value)
+        assert update_method(value, gradient_func, alpha, out=out) is out
+        assert np.allclose(out, update)
+        assert np.array_equal(value, [1.0, -2.0, 0.5])
+
+
+def test_early_stopper():
+    stopper = opt.EarlyStopper(max_fails=3, direction='minimize')
+    assert not stopper.stop(np.float32(2.0))
+    assert isinstance(stopper.best_objective, float)
+    assert not stopper.stop(1.0)
+    assert not stopper.stop(1.5)
+    assert stopper.fails == 1
+    assert stopper.stop(1.5)
+    assert stopper.reset().fails == 0
+    assert stopper.best_objective is None
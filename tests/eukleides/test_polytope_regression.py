@@ -0,0 +1,170 @@
+import warnings
+
+import numpy as np
+import pytest
+
+from eukleides import ConvexHull, _kernels
+from eukleides import optimization as opt
+from eukleides import polytope_regression as pr
+
+
+def test_softmax():
+    """ The softmax is a probability vector, also where the plain exponentials would overflow. """
+    coefs = pr.softmax(np.array([1000.0, 1000.0, -1000.0]))
+    assert np.allclose(coefs, [0.5, 0.5, 0.0])
+
+    rng = np.random.default_rng(0)
+    for lin_coefs in 100.0 * rng.standard_normal((10, 10)):
+        coefs = pr.softmax(lin_coefs)
+        assert np.all(coefs >= 0.0)
+        assert np.isclose(coefs.sum(), 1.0)
+        assert np.allclose(_kernels.softmax(lin_coefs, np.empty_like(lin_coefs)), coefs)
+        assert np.allclose(np.exp(pr.log_softmax(lin_coefs)), coefs)
+    assert np.allclose(pr.log_softmax(np.array([1000.0, 1000.0])), np.log([0.5, 0.5]))
+
+    stacked = 100.0 * rng.standard_normal((4, 10))
+    assert np.allclose(pr.softmax(stacked), [pr.softmax(row) for row in stacked])
+    assert np.allclose(np.exp(pr.log_softmax(stacked)), pr.softmax(stacked))
+
+
+def test_loss_gradient():
+    """ The gradient applies the softmax Jacobian, and agrees with the finite differences. """
+    rng = np.random.default_rng(0)
+    hull = ConvexHull(rng.random((6, 3)))
+    target = rng.random(3)
+    lin_coefs = rng.standard_normal(6)
+    with pytest.warns(DeprecationWarning):
+        jacobian = pr.comb_gradient(lin_coefs)
+    err = pr.calc_error(hull, target, lin_coefs)
+    gradient = pr.loss_gradient(hull, target, lin_coefs)
+    assert np.allclose(gradient, -(err @ hull.base) @ jacobian)
+    coefs = pr.softmax(lin_coefs)
+    assert np.allclose(pr._softmax_jvp(coefs, np.eye(6)), jacobian)  # pylint: disable=W0212
+
+    step = 1e-6
+    for k in range(6):
+        shift = np.zeros(6)
+        shift[k] = step
+        diff = pr.calc_loss(hull, target, lin_coefs + shift) - pr.calc_loss(hull, target, lin_coefs)
+        assert np.isclose(diff / step, 2.0 * gradient[k], atol=1e-5)
+
+
+def test_polyreg():
+    """
+    Recover a convex combination of points in the hull, both with more vertices than dimensions
+    and with fewer, where the loss goes through the Gram matrix of the hull.
+    """
+    rng = np.random.default_rng(0)
+    for num_points, dim in [(6, 3), (3, 6)]:
+        hull = ConvexHull(rng.random((num_points, dim)))
+        target = hull.base @ pr.softmax(rng.standard_normal(num_points))
+        for update_method in [opt.euler_update, opt.improved_euler_update, opt.runge_kutta_update]:
+            lin_coefs = pr.polyreg(
+                hull, target, update_method=update_method, rng=np.random.default_rng(0)
+            )
+            assert pr.calc_loss(hull, target, lin_coefs) < 1e-4
+            assert np.array_equal(
+                pr.polyreg(hull, target, update_method=update_method, rng=0),
+                lin_coefs,
+            )
+        lin_coefs = pr.polyreg(hull, target, dtype=np.float32)
+        assert lin_coefs.dtype == np.float32
+        assert pr.calc_loss(hull, target, lin_coefs) < 1e-4
+
+
+def test_polyreg_many(caplog):
+    """
+    The batched fits agree with polyreg on each target, from the same initial coefficients, and
+    the targets that did not converge are reported: all but the mean of the points, which the
+    nearly uniform initial coefficients already reach.
+    """
+    rng = np.random.default_rng(0)
+    hull = ConvexHull(rng.random((6, 3)))
+    combination = pr.softmax(rng.standard_normal(6)) @ hull.points
+    targets = np.stack([combination, hull.points.mean(axis=0), hull.points[0]])
+    for update_method in [opt.euler_update, opt.runge_kutta_update]:
+        batch = pr.polyreg_many(
+            hull, targets, update_method=update_method, rng=np.random.default_rng(0)
+        )
+        rng = np.random.default_rng(0)
+        for target, lin_coefs in zip(targets, batch):
+            assert pr.calc_loss(hull, target, lin_coefs) < 1e-4
+            assert np.allclose(
+                lin_coefs, pr.polyreg(hull, target, update_method=update_method, rng=rng)
+            )
+        caplog.clear()
+        pr.polyreg_many(hull, targets, update_method=update_method, max_iter=1)
+        assert '2 out of 3 targets did not converge.' in caplog.text
+        caplog.clear()
+        empty = pr.polyreg_many(hull, targets[:0], update_method=update_method)
+        assert empty.shape == (0, 6) and not caplog.text
+
+    dtypes = set()
+
+    def recorded_update(value, gradient_func, alpha):
+        update = opt.runge_kutta_update(value, gradient_func, alpha)
+        dtypes.add(update.dtype)
+        return update
+
+    batch = pr.polyreg_many(hull, targets, update_method=recorded_update, dtype=np.float32)
+    assert batch.dtype == np.float32 and dtypes == {np.dtype(np.float32)}
+
+
+def test_polyreg_lbfgs():
+    """
+    L-BFGS-B recovers the convex combinations, and the projection of a point outside, with the
+    gradient of the very loss it minimizes, as the finite differences check.
+    """
+    pytest.importorskip('scipy')
+    rng = np.random.default_rng(0)
+    for num_points, dim in [(6, 3), (3, 6)]:
+        hull = ConvexHull(rng.random((num_points, dim)))
+        target = hull.base @ pr.softmax(rng.standard_normal(num_points))
+        loss_and_gradient = pr._lbfgs_objective(hull, target)  # pylint: disable=W0212
+        lin_coefs = rng.standard_normal(num_points)
+        loss, gradient = loss_and_gradient(lin_coefs)
+        step = 1e-6
+        for k, shift in enumerate(step * np.eye(num_points)):
+            diff = loss_and_gradient(lin_coefs + shift)[0] - loss
+            assert np.isclose(diff / step, gradient[k], atol=1e-5)
+        lin_coefs = pr.polyreg_lbfgs(hull, target, rng=0)
+        assert pr.calc_loss(hull, target, lin_coefs) < 1e-4
+    outside = hull.points.max(axis=0) + 1.0
+    assert np.allclose(
+        pr.get_convex_combination(hull, pr.polyreg_lbfgs(hull, outside, rng=0)),
+        pr.get_convex_combination(hull, pr.polyreg(hull, outside, rng=0)),
+        atol=1e-2,
+    )
+
+
+def test_polyreg_fw():
+    """ Frank-Wolfe returns convex coefficients that recover the combination or the projection. """
+    rng = np.random.default_rng(0)
+    for num_points, dim in [(6, 3), (3, 6)]:
+        hull = ConvexHull(rng.random((num_points, dim)))
+        target = hull.base @ pr.softmax(rng.standard_normal(num_points))
+        coefs = pr.polyreg_fw(hull, target)
+        assert np.all(coefs >= 0.0)
+        assert np.isclose(coefs.sum(), 1.0)
+        err = target - hull.base @ coefs
+        assert err @ err < 1e-4
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        coefs = pr.polyreg_fw(hull, hull.points[0], tol=0.0)
+    assert np.allclose(hull.base @ coefs, hull.points[0])
+    outside = hull.points.max(axis=0) + 1.0
+    assert np.allclose(
+        hull.base @ pr.polyreg_fw(hull, outside),
+        pr.get_convex_combination(hull, pr.polyreg(hull, outside, rng=0)),
+        atol=1e-2,
+    )
+
+
+def test_precompile():
+    """ The fits then use the precompiled kernels, without compiling new ones. """
+    pr.precompile((np.float32, ))
+    compiled = getattr(_kernels.polyreg_euler, 'signatures', [])[:]
+    hull = ConvexHull(np.eye(3), dtype=np.float32)
+    lin_coefs = pr.polyreg(hull, hull.points.mean(axis=0), dtype=np.float32)
+    assert lin_coefs.dtype == np.float32
+    assert getattr(_kernels.polyreg_euler, 'signatures', []) == compiled